@@ -1,24 +1,60 @@
 from flask import Flask, render_template
-from elo_calculator import process_historical_data, DatabaseManager
+from flask_caching import Cache
+from elo_calculator import process_historical_data, DatabaseManager, cached_event_schedule
 from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime
 import logging
+import threading
 
 app = Flask(__name__)
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 3600})
 
 # Configure basic logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Create the schema once at startup so request handlers can open read-only connections
+DatabaseManager().close()
+
+# Shared by all request threads for the lifetime of the worker
+_db = DatabaseManager(read_only=True)
+
+def get_db():
+    """Return the worker's shared read-only database connection"""
+    return _db
+
+# Serializes the bootstrap, cron and manual updates
+_update_lock = threading.Lock()
+
 def scheduled_update():
     """Run the ELO rating update on schedule"""
     try:
-        logger.info("Running scheduled ELO update...")
-        process_historical_data(start_year=2018)  # Using our new function
-        logger.info("Update complete")
+        with _update_lock:
+            logger.info("Running scheduled ELO update...")
+            process_historical_data(start_year=2018)  # Using our new function
+            cache.clear()
+            logger.info("Update complete")
     except Exception as e:
         logger.error(f"Error during scheduled update: {e}")
 
+# Set once the startup load has finished, whether or not it saved any ratings
+_bootstrap_done = threading.Event()
+
+def _bootstrap_if_empty():
+    """Populate the database in the background on first start"""
+    try:
+        db = DatabaseManager()
+        is_empty = db.get_ratings().empty
+        db.close()
+        
+        if is_empty:
+            logger.info("No ratings found, starting initial data load...")
+            scheduled_update()
+    except Exception as e:
+        logger.error(f"Error during initial data load: {e}")
+    finally:
+        _bootstrap_done.set()
+
 # Initialize scheduler
 scheduler = BackgroundScheduler()
 scheduler.add_job(
@@ -30,26 +66,32 @@ scheduler.add_job(
 )
 scheduler.start()
 
+threading.Thread(target=_bootstrap_if_empty, daemon=True).start()
+
+@cache.memoize()
+def _render_index(last_updated):
+    """Render the ratings page; cached until the ratings are next saved"""
+    ratings = get_db().get_ratings()
+    return render_template(
+        'index.html',
+        ratings=ratings.to_dict('records'),
+        last_updated=last_updated
+    )
+
 @app.route('/')
 def index():
     """Main page showing driver ratings"""
     try:
-        db = DatabaseManager()
-        ratings = db.get_ratings()
+        db = get_db()
+        last_updated = db.get_last_update_time()
         
-        if ratings.empty:
-            # Initialize with some data if empty
-            process_historical_data(start_year=2018)
-            ratings = db.get_ratings()
-            
-        last_updated = db.get_last_update_time()  # You'll need to implement this in DatabaseManager
-        db.close()
+        if last_updated is None:
+            if not _bootstrap_done.is_set():
+                # The background bootstrap is still running
+                return render_template('warming_up.html'), 503, {'Retry-After': '60'}
+            return render_template('no_data.html')
         
-        return render_template(
-            'index.html',
-            ratings=ratings.to_dict('records'),
-            last_updated=last_updated
-        )
+        return _render_index(last_updated)
     except Exception as e:
         logger.error(f"Error loading ratings: {e}")
         return render_template('error.html', error=str(e)), 500
@@ -59,32 +101,15 @@ def force_update():
     """Endpoint for manual updates"""
     try:
         logger.info("Manual update triggered")
-        process_historical_data(start_year=2018)
-        return {"status": "success", "message": "Ratings updated successfully"}
+        # The current season's schedule may have changed since it was cached
+        cached_event_schedule.cache_clear()
+        scheduler.add_job(scheduled_update, next_run_time=datetime.now())
+        return {"status": "accepted", "message": "Ratings update started"}, 202
     except Exception as e:
         logger.error(f"Manual update failed: {e}")
         return {"status": "error", "message": str(e)}, 500
 
 if __name__ == '__main__':
-    # Initial data load when starting the server
-    try:
-        logger.info("Starting initial data load...")
-        process_historical_data(start_year=2018)
-    except Exception as e:
-        logger.error(f"Initial data load failed: {e}")
-    
+    # Initial data load runs in the background via _bootstrap_if_empty
     logger.info("Starting web server...")
     app.run(debug=True)
-
-from apscheduler.schedulers.background import BackgroundScheduler
-
-def update_elos():
-    from elo_calculator import process_historical_data
-    process_historical_data(start_year=2023)  # Adjust year as needed
-
-scheduler = BackgroundScheduler()
-scheduler.add_job(update_elos, 'cron', day_of_week='mon', hour=10)  # Mondays at 10 AM
-scheduler.start()
-
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
\ No newline at end of file
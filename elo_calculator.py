@@ -1,109 +1,191 @@
+import argparse
 import fastf1
+import functools
+import logging
 import pandas as pd
 import numpy as np
 import traceback
-import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import sqlite3
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 from typing import Optional
+from elo_kernel import elo_update
 
 fastf1.Cache.disabled()  
 
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 8
+
+@functools.lru_cache(maxsize=32)
+def cached_event_schedule(year: int) -> pd.DataFrame:
+    """Fetch a season's schedule at most once per process"""
+    return fastf1.get_event_schedule(year)
+
 class F1EloRating:
     def __init__(self, initial_rating: float = 1500, k_factor: float = 24):
-        self.ratings = {}
+        self._names = []
+        self._name_to_idx = {}
+        self._ratings = np.empty(0, dtype=np.float64)
         self.initial_rating = initial_rating
         self.k_factor = k_factor
+    
+    @property
+    def ratings(self) -> dict:
+        return dict(zip(self._names, self._ratings.tolist()))
+    
+    @ratings.setter
+    def ratings(self, ratings: dict):
+        self._names = list(ratings)
+        self._name_to_idx = {name: i for i, name in enumerate(self._names)}
+        self._ratings = np.fromiter(ratings.values(), dtype=np.float64, count=len(ratings))
+    
+    def _ensure(self, names):
+        """Append any unseen drivers with the initial rating"""
+        new_names = [name for name in dict.fromkeys(names) if name not in self._name_to_idx]
+        if not new_names:
+            return
+        
+        start = len(self._names)
+        for i, name in enumerate(new_names, start):
+            self._name_to_idx[name] = i
+        self._names.extend(new_names)
+        self._ratings = np.resize(self._ratings, len(self._names))
+        self._ratings[start:] = self.initial_rating
         
     def update_ratings(self, race_results: pd.DataFrame):
-        race_results = race_results.dropna(subset=['Driver', 'Position'])
+        self.update_ratings_from_arrays(race_results['Driver'].to_numpy(),
+                                        race_results['Position'].to_numpy(dtype=np.float64, na_value=np.nan))
+    
+    def update_ratings_from_arrays(self, drivers: np.ndarray, positions: np.ndarray):
+        """Apply one race given parallel arrays of driver names and finishing positions"""
+        positions = positions.astype(np.float64)
+        
+        # Drop unclassified rows once; opponents are implicit in the kernel's pairwise loop
+        mask = np.isfinite(positions) & ~pd.isna(drivers)
+        drivers, positions = drivers[mask], positions[mask].astype(np.int32)
         
-        if len(race_results) < 2:
+        if len(drivers) < 2:
             print("Not enough valid drivers to calculate ratings")
             return
         
         # Initialize new drivers
-        for driver in race_results['Driver'].unique():
-            if driver not in self.ratings:
-                self.ratings[driver] = self.initial_rating
+        self._ensure(drivers)
+        idx = np.fromiter((self._name_to_idx[d] for d in drivers), dtype=np.int64, count=len(drivers))
         
-        total_drivers = len(race_results)
-        
-        # Process each driver's result
-        for _, row in race_results.iterrows():
-            driver = row['Driver']
-            position = int(row['Position'])
-            
-            opponents = race_results[race_results['Driver'] != driver]
-            actual_score = 1 - (position - 1) / (total_drivers - 1)  # Normalized score
-            
-            # Calculate expected score against all opponents
-            expected_score = np.mean([
-                1 / (1 + 10 ** ((self.ratings[opp] - self.ratings[driver]) / 400))
-                for opp in opponents['Driver']
-            ])
-            
-            # Update rating
-            self.ratings[driver] += self.k_factor * (actual_score - expected_score)
+        # Update ratings
+        r = self._ratings[idx].astype(np.float32)
+        self._ratings[idx] = elo_update(r, positions, np.float32(self.k_factor))
     
     def get_driver_ratings(self) -> pd.DataFrame:
-        return pd.DataFrame.from_dict(self.ratings, orient='index', columns=['Elo Rating'])\
+        return pd.DataFrame({'Elo Rating': self._ratings}, index=self._names)\
                          .sort_values('Elo Rating', ascending=False)
 
 class F1DataCollector:
     def __init__(self, start_year: int = 2014):
         self.start_year = start_year
         self.current_year = datetime.now().year
-    
-    def get_all_historical_data(self) -> pd.DataFrame:
-        all_results = pd.DataFrame()
-        
-        for year in range(self.start_year, self.current_year + 1):
-            print(f"\nProcessing year {year}...")
-            year_results = self._process_year(year)
-            if not year_results.empty:
-                all_results = pd.concat([all_results, year_results])
+        # Past races that returned no results; (year, 0) marks a season whose schedule failed
+        self.missing_races = set()
+        # Historical results don't change, so serve repeat runs from disk
+        self._http = requests_cache.CachedSession(
+            'ergast_cache.sqlite',
+            expire_after=timedelta(days=30),
+            allowable_methods=('GET',)
+        )
         
-        return all_results
+        # Keep connections alive across the many Ergast lookups
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504))
+        )
+        self._http.mount('http://', adapter)
+        self._http.mount('https://', adapter)
     
-    def _process_year(self, year: int) -> pd.DataFrame:
-        try:
-            if year >= 2018:
-                schedule = fastf1.get_event_schedule(year)
-            else:
-                url = f"http://ergast.com/api/f1/{year}.json"
-                response = requests.get(url)
-                schedule = response.json()['MRData']['RaceTable']['Races']
-            
-            all_races = pd.DataFrame()
+    def close(self):
+        self._http.close()
+    
+    def get_all_historical_data(self, after: Optional[tuple] = None) -> pd.DataFrame:
+        """Collect results for every race after the (year, race_number) cursor, if given"""
+        frames = []
+        self.missing_races.clear()
+        today = pd.Timestamp(datetime.now().date())
+        
+        # One pool for every (year, race) so concurrent requests never exceed MAX_WORKERS
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {}
+            schedules = {}
+            for year in range(self.start_year, self.current_year + 1):
+                schedule = self._load_schedule(year)
+                if schedule is None:
+                    self.missing_races.add((year, 0))
+                    continue
+                
+                schedules[year] = schedule
+                race_nums = [race_num for race_num in range(1, len(schedule) + 1)
+                             if after is None or (year, race_num) > after]
+                print(f"\nQueueing {len(race_nums)} races for {year}...")
+                for race_num in race_nums:
+                    future = executor.submit(self.collect_race_results, year, race_num, schedule)
+                    futures[future] = (year, race_num)
             
-            for race_num in range(1, len(schedule) + 1):
-                print(f"  Processing race {race_num}...", end=' ')
-                race_results = self.collect_race_results(year, race_num)
+            # Races complete out of order; process_historical_data sorts them afterwards
+            for future in as_completed(futures):
+                year, race_num = futures[future]
+                race_results = future.result()
                 if not race_results.empty:
                     race_results['Year'] = year
                     race_results['RaceNumber'] = race_num
-                    all_races = pd.concat([all_races, race_results])
-                    print("✓")
+                    frames.append(race_results)
+                    print(f"  {year} race {race_num} ✓")
                 else:
-                    print("×")
+                    # Races that haven't been run yet aren't gaps
+                    if self._race_date(schedules[year], race_num) < today:
+                        self.missing_races.add((year, race_num))
+                    print(f"  {year} race {race_num} ×")
+        
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    
+    def _load_schedule(self, year: int):
+        try:
+            if year >= 2018:
+                schedule = cached_event_schedule(year)
+                # Testing events have no race session to load
+                return schedule[schedule['EventFormat'] != 'testing']
             
-            return all_races
+            url = f"http://ergast.com/api/f1/{year}.json"
+            response = self._http.get(url, timeout=10)
+            return response.json()['MRData']['RaceTable']['Races']
         
         except Exception as e:
-            print(f"Error processing year {year}: {e}")
+            print(f"Error loading schedule for {year}: {e}")
             traceback.print_exc()
-            return pd.DataFrame()
+            return None
+    
+    @staticmethod
+    def _race_date(schedule, race_num: int) -> pd.Timestamp:
+        if isinstance(schedule, pd.DataFrame):
+            return pd.Timestamp(schedule.iloc[race_num - 1]['EventDate'])
+        return pd.Timestamp(schedule[race_num - 1]['date'])
     
-    def collect_race_results(self, year: int, race_number: int) -> pd.DataFrame:
+    def collect_race_results(self, year: int, race_number: int, schedule=None) -> pd.DataFrame:
         if year >= 2018:
-            return self._collect_with_fastf1(year, race_number)
+            return self._collect_with_fastf1(year, race_number, schedule)
         return self._collect_with_ergast(year, race_number)
     
-    def _collect_with_fastf1(self, year: int, race_number: int) -> pd.DataFrame:
+    def _collect_with_fastf1(self, year: int, race_number: int,
+                             schedule: Optional[pd.DataFrame] = None) -> pd.DataFrame:
         try:
-            session = fastf1.get_session(year, race_number, 'R')
-            session.load(telemetry=False, weather=False)  # Faster loading
+            # Take the session from the already loaded Event; get_session would fetch the schedule again
+            if schedule is not None:
+                session = schedule.iloc[race_number - 1].get_race()
+            else:
+                session = fastf1.get_session(year, race_number, 'R')
+            session.load(laps=False, telemetry=False, weather=False, messages=False)  # Only results are needed
             results = session.results
             
             driver_column = next((col for col in ['FullName', 'Driver', 'driver'] 
@@ -123,34 +205,35 @@ class F1DataCollector:
     def _collect_with_ergast(self, year: int, race_number: int) -> pd.DataFrame:
         try:
             url = f"http://ergast.com/api/f1/{year}/{race_number}/results.json"
-            data = requests.get(url).json()
+            data = self._http.get(url, timeout=10).json()
             
             if not data['MRData']['RaceTable']['Races']:
                 return pd.DataFrame()
             
-            results = []
-            for result in data['MRData']['RaceTable']['Races'][0]['Results']:
-                try:
-                    results.append({
-                        'Driver': f"{result['Driver']['givenName']} {result['Driver']['familyName']}",
-                        'Position': int(result['position'])
-                    })
-                except (KeyError, ValueError):
-                    continue
-            
-            return pd.DataFrame(results)
+            df = pd.json_normalize(data['MRData']['RaceTable']['Races'][0]['Results'])
+            df['Driver'] = df['Driver.givenName'] + ' ' + df['Driver.familyName']
+            df['Position'] = pd.to_numeric(df['position'], errors='coerce')
+            return df[['Driver', 'Position']].dropna()
         
         except Exception as e:
             print(f"Ergast error: {e}")
             return pd.DataFrame()
 
 class DatabaseManager:
-    def __init__(self, db_name='f1_elo.db'):
-        self.conn = sqlite3.connect(db_name)
-        self._init_db()
+    def __init__(self, db_name='f1_elo.db', read_only: bool = False):
+        if read_only:
+            # Readers skip the DDL; the schema is created once by a writable instance.
+            # SQLite serializes access, so one read-only connection can be shared by threads.
+            self.conn = sqlite3.connect(f'file:{db_name}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(db_name)
+            self._init_db()
     
     def _init_db(self):
         cursor = self.conn.cursor()
+        # WAL lets the web app read while the updater writes
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS driver_ratings (
                 driver_name TEXT PRIMARY KEY,
@@ -158,66 +241,148 @@ class DatabaseManager:
                 last_updated TEXT
             )
         ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS metadata (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_rating ON driver_ratings (elo_rating DESC)')
+        # Backfill the last update time for databases created before it was tracked
+        cursor.execute('''
+            INSERT OR IGNORE INTO metadata (key, value)
+            SELECT 'last_updated', m FROM (SELECT MAX(last_updated) AS m FROM driver_ratings)
+            WHERE m IS NOT NULL
+        ''')
         self.conn.commit()
     
-    def save_ratings(self, ratings_df: pd.DataFrame):
-        cursor = self.conn.cursor()
+    def save_ratings(self, ratings_df: pd.DataFrame, last_processed: Optional[tuple] = None):
         current_time = datetime.now().isoformat()
+        rows = [(driver, float(row['Elo Rating']), current_time) for driver, row in ratings_df.iterrows()]
+        if not rows:
+            # Nothing to save, and a cursor or timestamp without ratings would be misleading
+            return
         
-        for driver, row in ratings_df.iterrows():
-            cursor.execute('''
+        with self.conn:
+            self.conn.executemany('''
                 INSERT OR REPLACE INTO driver_ratings (driver_name, elo_rating, last_updated)
                 VALUES (?, ?, ?)
-            ''', (driver, row['Elo Rating'], current_time))
-        
-        self.conn.commit()
+            ''', rows)
+            
+            self.conn.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('last_updated', ?)",
+                              (current_time,))
+            
+            # Commit the cursor together with the ratings it describes
+            if last_processed is not None:
+                self.conn.executemany('INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)', [
+                    ('last_year', str(last_processed[0])),
+                    ('last_race', str(last_processed[1]))
+                ])
     
-    def get_ratings(self) -> pd.DataFrame:
+    def get_last_processed(self) -> Optional[tuple]:
+        """Return the (year, race_number) of the last race applied to the ratings"""
         cursor = self.conn.cursor()
-        cursor.execute('SELECT driver_name, elo_rating FROM driver_ratings ORDER BY elo_rating DESC')
-        rows = cursor.fetchall()
-        return pd.DataFrame(rows, columns=['Driver', 'Elo Rating']) if rows else pd.DataFrame()
+        cursor.execute("SELECT key, value FROM metadata WHERE key IN ('last_year', 'last_race')")
+        values = dict(cursor.fetchall())
+        if 'last_year' not in values or 'last_race' not in values:
+            return None
+        return int(values['last_year']), int(values['last_race'])
+    
+    def get_ratings(self) -> pd.DataFrame:
+        return pd.read_sql_query(
+            'SELECT driver_name AS Driver, elo_rating AS "Elo Rating" FROM driver_ratings ORDER BY elo_rating DESC',
+            self.conn
+        )
     
     def close(self):
         self.conn.close()
 
     def get_last_update_time(self):
         cursor = self.conn.cursor()
-        cursor.execute('SELECT MAX(last_updated) FROM driver_ratings')
+        cursor.execute("SELECT value FROM metadata WHERE key = 'last_updated'")
         result = cursor.fetchone()
-        return result[0] if result else "Never"
+        return result[0] if result else None
 
-def process_historical_data(start_year: int = 2014):
+def process_historical_data(start_year: int = 2014, rebuild: bool = False):
     print("Starting historical data processing...")
-    collector = F1DataCollector(start_year)
     elo = F1EloRating()
     db = DatabaseManager()
+    collector = None
     
-    # Load existing ratings if any
-    existing_ratings = db.get_ratings()
-    if not existing_ratings.empty:
-        elo.ratings = existing_ratings.set_index('Driver')['Elo Rating'].to_dict()
-    
-    # Get all historical race results
-    all_races = collector.get_all_historical_data()
-    
-    if not all_races.empty:
-        # Process races in chronological order
-        for (year, race_num), race_group in all_races.groupby(['Year', 'RaceNumber']):
-            print(f"\nProcessing {year} Race {race_num}...")
-            elo.update_ratings(race_group)
+    try:
+        # Resume from the last processed race unless a full rebuild is requested
+        last_processed = None if rebuild else db.get_last_processed()
         
-        # Save final ratings
-        db.save_ratings(elo.get_driver_ratings())
-        print("\nFinal ratings saved to database.")
-    else:
-        print("No race data was collected.")
-    
-    db.close()
-    return elo.get_driver_ratings()
+        # Load existing ratings if any
+        existing_ratings = db.get_ratings()
+        if existing_ratings.empty:
+            # A cursor without ratings can't be resumed from; replay everything
+            last_processed = None
+        elif last_processed is not None:
+            elo.ratings = existing_ratings.set_index('Driver')['Elo Rating'].to_dict()
+            start_year = max(start_year, last_processed[0])
+            print(f"Resuming after {last_processed[0]} Race {last_processed[1]}")
+        
+        collector = F1DataCollector(start_year)
+        
+        # Get all historical race results
+        # Races already reflected in the stored ratings aren't fetched at all
+        all_races = collector.get_all_historical_data(after=last_processed)
+        
+        if not all_races.empty:
+            all_races = all_races.sort_values(['Year', 'RaceNumber'], kind='mergesort', ignore_index=True)
+        
+        # Ratings depend on race order, so never apply a race past one that failed to load.
+        # The cursor then stops before the gap and the next run retries from there.
+        pending = sorted(collector.missing_races)
+        if pending:
+            hole_year, hole_race = pending[0]
+            hole = f"the {hole_year} schedule" if hole_race == 0 else f"{hole_year} Race {hole_race}"
+            logger.warning(f"No results for {hole}; ratings will not advance past it until it loads")
+            
+            if not all_races.empty:
+                before_hole = (all_races['Year'] < hole_year) | \
+                              ((all_races['Year'] == hole_year) & (all_races['RaceNumber'] < hole_race))
+                all_races = all_races[before_hole]
+        
+        if not all_races.empty:
+            years = all_races['Year'].to_numpy()
+            race_nums = all_races['RaceNumber'].to_numpy()
+            drivers = all_races['Driver'].to_numpy()
+            positions = all_races['Position'].to_numpy()
+            
+            # Rows are sorted, so each race is a contiguous slice between these boundaries
+            break_idx = np.flatnonzero(np.diff(race_nums) | np.diff(years)) + 1
+            starts = np.concatenate(([0], break_idx))
+            ends = np.concatenate((break_idx, [len(all_races)]))
+            
+            # Process races in chronological order
+            for start, end in zip(starts, ends):
+                year, race_num = int(years[start]), int(race_nums[start])
+                print(f"\nProcessing {year} Race {race_num}...")
+                elo.update_ratings_from_arrays(drivers[start:end], positions[start:end])
+                last_processed = (year, race_num)
+            
+            # Save final ratings
+            db.save_ratings(elo.get_driver_ratings(), last_processed)
+            print("\nFinal ratings saved to database.")
+        else:
+            print("No new race data was collected.")
+        
+        return elo.get_driver_ratings()
+    finally:
+        # Release the HTTP pool and cache handles even if collection or saving fails
+        if collector is not None:
+            collector.close()
+        db.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update F1 driver Elo ratings")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="Reprocess every race instead of only new ones")
+    args = parser.parse_args()
+    
     # Example: Process data from 2018 to current year
-    ratings = process_historical_data(start_year=2018)
+    ratings = process_historical_data(start_year=2018, rebuild=args.rebuild)
     print("\nCurrent Driver Ratings:")
     print(ratings.head(20))
\ No newline at end of file
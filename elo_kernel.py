@@ -0,0 +1,28 @@
+import math
+import numpy as np
+from numba import njit
+
+# 10 ** (x / 400) == exp(x * ln(10) / 400)
+LN10_OVER_400 = np.float32(math.log(10) / 400.0)
+
+
+# Ratings only carry a few significant digits, so the pairwise math runs in float32.
+# The explicit signature compiles at import, so the first race doesn't pay for it.
+@njit('float32[:](float32[:], int32[:], float32)', cache=True, fastmath=True)
+def elo_update(r, positions, k):
+    """Return updated ratings for one race given pre-race ratings and finishing positions."""
+    n = r.shape[0]
+    inv_opponents = np.float32(1.0) / np.float32(n - 1)
+    updated = np.empty(n, dtype=np.float32)
+    
+    for i in range(n):
+        s = np.float32(0.0)
+        ri = r[i]
+        for j in range(n):
+            if i != j:
+                s += np.float32(1.0) / (np.float32(1.0) + math.exp(LN10_OVER_400 * (r[j] - ri)))
+        expected = s * inv_opponents
+        actual = np.float32(1.0) - np.float32(positions[i] - 1) * inv_opponents
+        updated[i] = ri + k * (actual - expected)
+    
+    return updated